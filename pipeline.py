@@ -1,25 +1,45 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
-import json
+import asyncio
+import http.cookiejar
+import itertools
+import mmap
 import os
 import random
+import re
+import shlex
 import shutil
 import socket
+import struct
 import subprocess
 import sys
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Iterable, List, Optional, Tuple
+from typing import IO, Callable, Iterable, List, Optional, Tuple
 
 import click
+import numpy as np
+import orjson
 from loguru import logger
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
 except Exception:  # 允许在无 requests 时仍能运行非 HTTP 探测
     requests = None  # type: ignore
 
+try:
+    import uvloop
+except Exception:  # uvloop 不支持 Windows，缺失时使用 asyncio 默认事件循环
+    uvloop = None  # type: ignore
+
+try:
+    import resource
+except Exception:  # Windows 无 resource 模块
+    resource = None  # type: ignore
+
 # 目标端口与服务映射可以由 CLI 或配置覆盖
 DEFAULT_SPECIFIED_PORTS = [
     {"proto": "tcp", "port": 80},
@@ -37,11 +57,35 @@ run_timeout = 30
 
 RANDOM_HIGH_PORT_RANGE = (20000, 65535)
 
+# masscan 列表输出中的主机行，形如：Host: 1.2.3.4 () 80
+_HOST_PREFIX = b"Host:"
+_MASSCAN_HOST_RE = re.compile(rb"^" + re.escape(_HOST_PREFIX) + rb" (\S+)", re.MULTILINE)
+
+# 大文件写出：1 MB 缓冲，并按批 writelines，减少 write() 系统调用与逐行方法调用
+WRITE_BUFFER = 1 << 20
+WRITE_BATCH = 10000
+READ_CHUNK = 1 << 16  # 流式读取 IP 列表时每块的 IP 数（uint32 块约 256 KB）
+JSONL_BATCH = 1024  # 阶段2 探测结果按条数批量写出
+
+# 只需读 banner 的服务：阶段2 走 asyncio 探测
+BANNER_SERVICES = {"ssh", "ftp", "mysql"}
 
-def run(cmd: List[str], capture: bool = False, check: bool = True, timeout: Optional[float] = None) -> Optional[subprocess.CompletedProcess]:
+HTTP_BODY_LIMIT = 4096  # HTTP 探测最多读取的响应体字节数
+
+# 全局复用一个 Session：避免每次探测都重建适配器/连接池；连接池需覆盖阶段2 的并发线程数
+if requests is not None:
+    _SESSION = requests.Session()
+    _SESSION.mount("http://", HTTPAdapter(pool_connections=512, pool_maxsize=512, pool_block=False, max_retries=0))
+    # 扫描不需要保存 Cookie：拒绝所有域，避免 cookie jar 随探测主机数无限增长、各线程争用其锁
+    _SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+else:
+    _SESSION = None
+
+
+def run(cmd: List[str], capture: bool = False, check: bool = True, timeout: Optional[float] = None, stdout: Optional[IO] = None) -> Optional[subprocess.CompletedProcess]:
     logger.debug("$ {}", " ".join(cmd))
     try:
-        return subprocess.run(cmd, capture_output=capture, text=True, check=check, timeout=timeout)
+        return subprocess.run(cmd, capture_output=capture, stdout=stdout, text=True, check=check, timeout=timeout)
     except subprocess.TimeoutExpired:
         logger.warning("命令超时（{} 秒）：{}", timeout, " ".join(cmd))
         return None
@@ -51,6 +95,26 @@ def ensure_output_dir(path: Path) -> None:
     path.mkdir(parents=True, exist_ok=True)
 
 
+def concat_files(srcs: Iterable[Path], dst: Path) -> Path:
+    # 用 sendfile 在内核内直接拷贝，不经过用户态缓冲；平台不支持时退回 copyfileobj
+    with open(dst, "wb") as wf:
+        for src in srcs:
+            with open(src, "rb") as rf:
+                size = os.fstat(rf.fileno()).st_size
+                offset = 0
+                try:
+                    while offset < size:
+                        sent = os.sendfile(wf.fileno(), rf.fileno(), offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                except (AttributeError, OSError):
+                    if offset:
+                        raise
+                    shutil.copyfileobj(rf, wf)
+    return dst
+
+
 @dataclass
 class ScanConfig:
     specified_ports: list
@@ -63,6 +127,29 @@ class ScanConfig:
     seed: int = 1337
     exclude_file: Optional[Path] = None
     scanner: str = "auto"  # auto|zmap|masscan
+    probe_workers: int = 256  # 阶段2 并发探测线程数
+    banner_concurrency: int = 4096  # 阶段2 banner 类服务的 asyncio 并发连接数
+    scan_workers: int = 2  # 并发扫描任务数，总速率在任务间均分
+    bandwidth: Optional[str] = None  # zmap -B 带宽（如 10G），设置后替代 -r 速率
+    send_threads: int = 4  # zmap -T 发送线程数
+    probe_module: str = "tcp_synscan"
+    shards: List[str] = field(default_factory=list)  # 分片扫描的 SSH 主机列表，每台主机跑一个 zmap 分片
+    _resolved_scanner: Optional[str] = field(default=None, init=False, repr=False)  # zmap|masscan，None 表示未找到
+    _scanner_path: Optional[str] = field(default=None, init=False, repr=False)
+    # 本次运行内已完成的扫描：(target_port, src_port, target_ips) -> 结果 CSV
+    _scan_cache: dict = field(default_factory=dict, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        # 扫描器只在构造时解析一次（auto 优先 zmap），避免每次扫描都遍历 PATH
+        if self.scanner in ("zmap", "masscan"):
+            self._resolved_scanner = self.scanner
+            self._scanner_path = which(self.scanner) or self.scanner
+            return
+        for name in ("zmap", "masscan"):
+            path = which(name)
+            if path:
+                self._resolved_scanner, self._scanner_path = name, path
+                return
 
 
 def pick_random_high_port(seed: int) -> int:
@@ -74,40 +161,100 @@ def which(name: str) -> Optional[str]:
     return shutil.which(name)
 
 
+def pf_ring_available() -> bool:
+    # 加载了 PF_RING 内核模块时存在该文件
+    return os.path.exists("/proc/net/pf_ring")
+
+
+_BANDWIDTH_UNITS = {"": 1, "K": 10**3, "M": 10**6, "G": 10**9}
+
+
+def split_bandwidth(bandwidth: str, parts: int) -> str:
+    # 将 zmap 风格的带宽（如 10G / 500M / 1000000）均分为 parts 份，返回 bps 数值
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMG]?)", bandwidth.strip(), re.IGNORECASE)
+    if not m:
+        raise ValueError(f"无法解析带宽：{bandwidth}")
+    bps = float(m.group(1)) * _BANDWIDTH_UNITS[m.group(2).upper()]
+    return str(max(1, int(bps // max(1, parts))))
+
+
 # ------------------------- 扫描器封装 -------------------------
 
-def zmap_scan(target_port: int, rate: int, iface: Optional[str], source_port: Optional[int], output: Path, exclude_file: Optional[Path] = None, target_ips: Optional[Path] = None) -> Path:
-    ensure_output_dir(output.parent)
-    # 预创建输出文件，保证后续流程有文件可读
-    try:
-        output.touch(exist_ok=True)
-    except Exception:
-        pass
+def _zmap_cmd(target_port: int, rate: int, iface: Optional[str], source_port: Optional[int], output: str, exclude_file: Optional[Path] = None, target_ips: Optional[Path] = None, bandwidth: Optional[str] = None, send_threads: Optional[int] = None, probe_module: str = "tcp_synscan", extra_args: Optional[List[str]] = None, binary: str = "zmap") -> List[str]:
     cmd = [
-        "zmap",
+        binary,
         "-p",
         str(target_port),
         "-o",
-        str(output),
-        "-r",
-        str(rate),
+        output,
+        f"--probe-module={probe_module}",
         "--verbosity=2",
     ]
+    # 按带宽限速（-B）时不再传 -r
+    if bandwidth:
+        cmd += ["-B", bandwidth]
+    else:
+        cmd += ["-r", str(rate)]
+    if send_threads:
+        cmd += ["-T", str(send_threads)]
     if iface:
         cmd += ["-i", iface]
     if source_port:
         cmd += ["--source-port", str(source_port)]
     if exclude_file:
-        cmd += ["-w", str(exclude_file)]
+        cmd += ["-b", str(exclude_file)]  # -b 为排除列表（-w 是白名单）
+    if extra_args:
+        cmd += extra_args
     if target_ips:
         cmd += ["-w", str(target_ips)]
     else:
         cmd += ["0.0.0.0/0"]  # 默认扫描全网
+    return cmd
+
+
+def zmap_scan(target_port: int, rate: int, iface: Optional[str], source_port: Optional[int], output: Path, exclude_file: Optional[Path] = None, target_ips: Optional[Path] = None, bandwidth: Optional[str] = None, send_threads: Optional[int] = None, probe_module: str = "tcp_synscan", binary: str = "zmap") -> Path:
+    ensure_output_dir(output.parent)
+    # 预创建输出文件，保证后续流程有文件可读
+    try:
+        output.touch(exist_ok=True)
+    except Exception:
+        pass
+    cmd = _zmap_cmd(target_port, rate, iface, source_port, str(output), exclude_file=exclude_file, target_ips=target_ips, bandwidth=bandwidth, send_threads=send_threads, probe_module=probe_module, binary=binary)
     run(cmd, timeout=run_timeout)
     return output
 
 
-def masscan_scan(target_port: int, rate: int, iface: Optional[str], source_port: Optional[int], output: Path, exclude_file: Optional[Path] = None, target_ips: Optional[Path] = None) -> Path:
+def zmap_sharded_scan(hosts: List[str], seed: int, target_port: int, rate: int, source_port: Optional[int], output: Path, exclude_file: Optional[Path] = None, bandwidth: Optional[str] = None, send_threads: Optional[int] = None, probe_module: str = "tcp_synscan") -> Path:
+    # 每台主机经 SSH 运行 zmap 的一个分片：相同 --seed 下 --shards/--shard 保证各分片地址互不重叠、合起来覆盖全网。
+    # 各分片结果经 stdout 回传到本地分片文件，最后拼接为 output。rate/bandwidth 为每台主机各自的预算；
+    # exclude_file 需在远端主机的相同路径下存在；本机网卡名在远端无意义，不下发 -i，由远端 zmap 自选默认网卡
+    ensure_output_dir(output.parent)
+    shard_outs = [output.with_name(f"{output.stem}.shard{i}{output.suffix}") for i in range(len(hosts))]
+
+    def scan_shard(i: int, host: str) -> None:
+        shard_args = [f"--shards={len(hosts)}", f"--shard={i}", f"--seed={seed}"]
+        remote_cmd = _zmap_cmd(target_port, rate, None, source_port, "-", exclude_file=exclude_file, bandwidth=bandwidth, send_threads=send_threads, probe_module=probe_module, extra_args=shard_args)
+        with open(shard_outs[i], "w") as f:
+            result = run(["ssh", "-o", "BatchMode=yes", host, shlex.join(remote_cmd)], check=False, timeout=run_timeout, stdout=f)
+        # 与本地扫描的 check=True 一致：远端失败直接报错，避免静默丢失一个分片的地址空间
+        if result is None:
+            logger.warning("分片 {}/{}（{}）超时，结果可能不完整", i, len(hosts), host)
+        elif result.returncode != 0:
+            raise RuntimeError(f"分片 {i}/{len(hosts)}（{host}）zmap 执行失败，退出码 {result.returncode}")
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(hosts)) as ex:
+            for fut in [ex.submit(scan_shard, i, host) for i, host in enumerate(hosts)]:
+                fut.result()
+        concat_files(shard_outs, output)
+    finally:
+        # 任一分片失败时也清理分片文件，避免残留在输出目录
+        for shard_out in shard_outs:
+            shard_out.unlink(missing_ok=True)
+    return output
+
+
+def masscan_scan(target_port: int, rate: int, iface: Optional[str], source_port: Optional[int], output: Path, exclude_file: Optional[Path] = None, target_ips: Optional[Path] = None, binary: str = "masscan") -> Path:
     ensure_output_dir(output.parent)
     # masscan 输出支持 -oL（列表）或 -oJ（JSON）。这里使用 -oL，之后统一转 .csv 兼容 extract。
     out_list = output.with_suffix(".list")
@@ -125,7 +272,7 @@ def masscan_scan(target_port: int, rate: int, iface: Optional[str], source_port:
         scan_target = "0.0.0.0/0"  # 默认扫描全网
     
     cmd = [
-        "masscan",
+        binary,
         scan_target,
         "-p",
         str(target_port),
@@ -143,28 +290,73 @@ def masscan_scan(target_port: int, rate: int, iface: Optional[str], source_port:
     if exclude_file:
         cmd += ["--excludefile", str(exclude_file)]
     run(cmd, timeout=run_timeout)
-    # 解析 -oL 为简单 CSV（ip,port）
-    if out_list.exists():
-        with open(out_list, "r", encoding="utf-8", errors="ignore") as rf, open(output, "w", encoding="utf-8") as wf:
-            for line in rf:
-                if line.startswith("Host:"):
-                    # 形如：Host: 1.2.3.4 () 80
-                    parts = line.strip().split()
-                    if len(parts) >= 2:
-                        ip = parts[1]
-                        wf.write(f"{ip},{target_port}\n")
+    # 解析 -oL 为简单 CSV（ip,port）：mmap 整个文件，用一次正则扫描在 C 层完成匹配
+    port_tail = f",{target_port}\n".encode()
+    with open(output, "wb", buffering=WRITE_BUFFER) as wf:
+        if out_list.exists() and out_list.stat().st_size > 0:
+            with open(out_list, "rb") as rf, mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # 先用 find 定位首个 "Host:"（C 层 memchr/memcmp），跳过文件头注释；没有主机行时整段不进正则
+                start = mm.find(_HOST_PREFIX)
+                if start == -1:
+                    start = len(mm)
+                buf: List[bytes] = []
+                for m in _MASSCAN_HOST_RE.finditer(mm, start):
+                    buf.append(m.group(1) + port_tail)
+                    if len(buf) >= WRITE_BATCH:
+                        wf.writelines(buf)
+                        buf.clear()
+                wf.writelines(buf)
     return output
 
 
-def scan_dispatch(cfg: ScanConfig, target_port: int, src_port: Optional[int], tag: str, target_ips: Optional[Path] = None) -> Path:
+def _scan_key(target_port: int, src_port: Optional[int], target_ips: Optional[Path]) -> Tuple[int, Optional[int], Optional[Path]]:
+    return target_port, src_port, target_ips
+
+
+def scan_dispatch(cfg: ScanConfig, target_port: int, src_port: Optional[int], tag: str, target_ips: Optional[Path] = None, rate: Optional[int] = None, bandwidth: Optional[str] = None) -> Path:
+    # 同一 (目标端口, 源端口, 目标列表) 在一次运行内只扫一次，重复请求直接复用首次的结果 CSV
+    key = _scan_key(target_port, src_port, target_ips)
+    cached = cfg._scan_cache.get(key)
+    if cached is not None:
+        logger.debug("复用扫描结果：{}", cached)
+        return cached
+    out = _scan_uncached(cfg, target_port, src_port, tag, target_ips, rate, bandwidth)
+    cfg._scan_cache[key] = out
+    return out
+
+
+def _scan_uncached(cfg: ScanConfig, target_port: int, src_port: Optional[int], tag: str, target_ips: Optional[Path], rate: Optional[int], bandwidth: Optional[str]) -> Path:
     out = cfg.output_dir / f"scan_{tag}_src{src_port or 'auto'}_to{target_port}.csv"
-    if cfg.scanner == "zmap" or (cfg.scanner == "auto" and which("zmap")):
-        return zmap_scan(target_port=target_port, rate=cfg.rate, iface=cfg.iface, source_port=src_port, output=out, exclude_file=cfg.exclude_file, target_ips=target_ips)
-    if cfg.scanner == "masscan" or (cfg.scanner == "auto" and which("masscan")):
-        return masscan_scan(target_port=target_port, rate=cfg.rate, iface=cfg.iface, source_port=src_port, output=out, exclude_file=cfg.exclude_file, target_ips=target_ips)
+    rate = rate or cfg.rate
+    bandwidth = bandwidth or cfg.bandwidth
+    if cfg.shards and target_ips is None:
+        # 全网扫描才分片；在候选列表内的复扫规模小，且列表文件只在本地，仍在本机执行
+        return zmap_sharded_scan(cfg.shards, cfg.seed, target_port=target_port, rate=rate, source_port=src_port, output=out, exclude_file=cfg.exclude_file, bandwidth=bandwidth, send_threads=cfg.send_threads, probe_module=cfg.probe_module)
+    if cfg._resolved_scanner == "zmap":
+        return zmap_scan(target_port=target_port, rate=rate, iface=cfg.iface, source_port=src_port, output=out, exclude_file=cfg.exclude_file, target_ips=target_ips, bandwidth=bandwidth, send_threads=cfg.send_threads, probe_module=cfg.probe_module, binary=cfg._scanner_path)
+    if cfg._resolved_scanner == "masscan":
+        return masscan_scan(target_port=target_port, rate=rate, iface=cfg.iface, source_port=src_port, output=out, exclude_file=cfg.exclude_file, target_ips=target_ips, binary=cfg._scanner_path)
     raise RuntimeError("未找到可用扫描器：请安装 zmap 或 masscan 并加入 PATH，或用 --scanner 指定")
 
 
+# (target_port, src_port, tag, target_ips)
+ScanJob = Tuple[int, Optional[int], str, Optional[Path]]
+
+
+def scan_many(cfg: ScanConfig, jobs: List[ScanJob]) -> List[Path]:
+    # 扫描进程大部分时间在等网卡/冷却，多个扫描并发可重叠启动与收尾；
+    # 总速率在并发任务间均分，避免超出带宽预算。参数相同的任务只提交一次，结果顺序与 jobs 一致
+    unique_jobs: dict = {}
+    for port, src, tag, ips in jobs:
+        unique_jobs.setdefault(_scan_key(port, src, ips), (port, src, tag, ips))
+    workers = max(1, min(cfg.scan_workers, len(unique_jobs)))
+    rate = max(1, cfg.rate // workers)
+    bandwidth = split_bandwidth(cfg.bandwidth, workers) if cfg.bandwidth else None
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = {key: ex.submit(scan_dispatch, cfg, target_port=port, src_port=src, tag=tag, target_ips=ips, rate=rate, bandwidth=bandwidth) for key, (port, src, tag, ips) in unique_jobs.items()}
+        return [futures[_scan_key(port, src, ips)].result() for port, src, _, ips in jobs]
+
+
 # ------------------------- 简单应用层探测 -------------------------
 
 def tcp_banner(target_ip: str, port: int, timeout: float = 3.0, payload: Optional[bytes] = None) -> Optional[str]:
@@ -192,8 +384,14 @@ def probe_http(ip: str, port: int) -> Optional[dict]:
         return {"type": "raw", "data": banner[:256]}
     try:
         url = f"http://{ip}:{port}/"
-        r = requests.get(url, timeout=5)
-        return {"code": r.status_code, "server": r.headers.get("Server"), "len": len(r.content)}
+        # stream=True + 限长读取，避免把超大响应体整个拉回来；多读 1 字节用于判断是否截断
+        with _SESSION.get(url, timeout=5, allow_redirects=False, stream=True) as r:
+            body = r.raw.read(HTTP_BODY_LIMIT + 1, decode_content=True)
+            truncated = len(body) > HTTP_BODY_LIMIT
+            # len 保持“响应体长度”的含义：有 Content-Length 时取其值，否则为实际读到的字节数（截断时见 truncated）
+            content_length = r.headers.get("Content-Length", "")
+            length = int(content_length) if content_length.isdigit() else min(len(body), HTTP_BODY_LIMIT)
+            return {"code": r.status_code, "server": r.headers.get("Server"), "len": length, "truncated": truncated}
     except Exception:
         return None
 
@@ -201,6 +399,7 @@ def probe_http(ip: str, port: int) -> Optional[dict]:
 def probe_service(ip: str, svc_name: str, port: int) -> Optional[dict]:
     if svc_name == "http":
         return probe_http(ip, port)
+    # BANNER_SERVICES 在管道中走 _probe_banners（asyncio），以下同步分支仅保留给直接调用者
     if svc_name == "ssh":
         banner = tcp_banner(ip, port)
         return {"banner": banner} if banner else None
@@ -213,23 +412,229 @@ def probe_service(ip: str, svc_name: str, port: int) -> Optional[dict]:
     return None
 
 
-def filter_ips_by_not_in(other: Path, base: Path, out: Path) -> Path:
-    with open(base, "r") as fb:
-        base_set = set(ip.strip() for ip in fb if ip.strip())
-    with open(other, "r") as fo:
-        other_set = set(ip.strip() for ip in fo if ip.strip())
-    remaining = base_set - other_set
-    with open(out, "w") as fw:
-        for ip in sorted(remaining):
-            fw.write(ip + "\n")
+def _probe_one(ip: str, svc_name: str, port: int) -> Optional[dict]:
+    # 线程池任务入口：单个 IP 的探测异常不应中断整批探测
+    try:
+        return probe_service(ip, svc_name, port)
+    except Exception as e:
+        logger.debug("探测 {}:{} 失败：{}", ip, port, e)
+        return None
+
+
+async def tcp_banner_async(target_ip: str, port: int, timeout: float = 3.0, payload: Optional[bytes] = None) -> Optional[str]:
+    # 与 tcp_banner 语义一致：连不上返回 None，连上但读超时返回空串
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(target_ip, port), timeout)
+    except Exception:
+        return None
+    try:
+        if payload:
+            writer.write(payload)
+            await asyncio.wait_for(writer.drain(), timeout)
+        try:
+            data = await asyncio.wait_for(reader.read(256), timeout)
+        except asyncio.TimeoutError:
+            data = b""
+        return data.decode("latin-1", errors="ignore")
+    except Exception:
+        return None
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+
+def _fd_budget(wanted: int) -> int:
+    # 并发连接数不超过进程可用文件描述符（预留 64 个给日志/输出文件等），否则超出部分会直接连接失败
+    if resource is None:
+        return wanted
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return wanted
+    return max(1, min(wanted, soft - 64))
+
+
+async def _probe_banners(ips: List[str], port: int, concurrency: int, emit: Callable[[str, dict], None]) -> int:
+    sem = asyncio.Semaphore(_fd_budget(concurrency))
+
+    async def probe(ip: str) -> Tuple[str, Optional[str]]:
+        async with sem:
+            return ip, await tcp_banner_async(ip, port)
+
+    count = 0
+    for fut in asyncio.as_completed([probe(ip) for ip in ips]):
+        ip, banner = await fut
+        if banner:
+            emit(ip, {"banner": banner})
+            count += 1
+    return count
+
+
+def _run_async(coro):
+    if uvloop is not None:
+        return uvloop.run(coro)
+    return asyncio.run(coro)
+
+
+def probe_candidates(ips: List[str], svc_name: str, port: int, cfg: ScanConfig, emit: Callable[[str, dict], None]) -> int:
+    # 探测耗时主要在网络等待（RTT/超时）。banner 类服务用单线程事件循环支撑大量并发连接；
+    # HTTP 依赖同步的 requests，用线程池并发。结果按完成顺序交给 emit，返回有响应的数量
+    if svc_name in BANNER_SERVICES:
+        return _run_async(_probe_banners(ips, port, cfg.banner_concurrency, emit))
+    count = 0
+    with ThreadPoolExecutor(max_workers=cfg.probe_workers) as ex:
+        futures = {ex.submit(_probe_one, ip, svc_name, port): ip for ip in ips}
+        for fut in as_completed(futures):
+            res = fut.result()
+            if res is not None:
+                emit(futures[fut], res)
+                count += 1
+    return count
+
+
+# ------------------------- IP 列表处理 -------------------------
+# IPv4 统一按 uint32 存放于 numpy 数组：每个 IP 4 字节，集合运算走 numpy 的排序/去重
+
+def ip_to_u32(ip: str) -> int:
+    return struct.unpack(">I", socket.inet_aton(ip))[0]
+
+
+def _iter_ips_u32(lines: Iterable[str]) -> Iterable[int]:
+    # 取每行第一列作为 IP 逐行转 uint32，跳过空行、注释与表头（如 zmap 的 saddr）等非 IP 行；
+    # 逐个产出整数交给 np.fromiter，不为每行保留中间对象
+    aton = socket.inet_aton
+    for line in lines:
+        ip = line.partition(",")[0].strip()
+        if not ip or ip.startswith("#"):
+            continue
+        try:
+            yield int.from_bytes(aton(ip), "big")
+        except OSError:
+            continue
+
+
+def _load_ips_u32(path: Path) -> np.ndarray:
+    with open(path, "r") as f:
+        return np.fromiter(_iter_ips_u32(f), dtype=np.uint32)
+
+
+def _iter_ips_u32_chunks(path: Path) -> Iterable[np.ndarray]:
+    # 每块最多 READ_CHUNK 个 IP，逐行流式解析，峰值内存与文件大小无关
+    with open(path, "r") as f:
+        ips = _iter_ips_u32(f)
+        while True:
+            chunk = np.fromiter(itertools.islice(ips, READ_CHUNK), dtype=np.uint32)
+            if chunk.size == 0:
+                return
+            yield chunk
+
+
+def _unique_u32_inplace(ips: np.ndarray) -> np.ndarray:
+    # 原地排序后按相邻元素去重，避免 np.unique 内部再复制一份输入；会修改传入数组
+    ips.sort(kind="quicksort")
+    if ips.size == 0:
+        return ips
+    keep = np.empty(ips.size, dtype=bool)
+    keep[0] = True
+    np.not_equal(ips[1:], ips[:-1], out=keep[1:])
+    return ips[keep]
+
+
+def u32s_to_ips(ips: np.ndarray) -> List[str]:
+    # 整个数组一次转为大端字节串后按 4 字节切片交给 inet_ntoa，省去逐元素的 numpy 标量转换与 struct.pack
+    raw = ips.astype(">u4").tobytes()
+    return [socket.inet_ntoa(raw[i:i + 4]) for i in range(0, len(raw), 4)]
+
+
+def _write_ips_u32(ips: np.ndarray, out: Path) -> Path:
+    with open(out, "w", encoding="utf-8", buffering=WRITE_BUFFER) as fw:
+        for start in range(0, ips.size, WRITE_BATCH):
+            fw.write("\n".join(u32s_to_ips(ips[start:start + WRITE_BATCH])) + "\n")
     return out
 
 
+def _set_bit_range(bitmap: np.ndarray, start: int, end: int) -> None:
+    # 置位 [start, end]（闭区间）内每个地址对应的 bit；整字节部分按切片整体赋值
+    first, last = start >> 3, end >> 3
+    head = (0xFF << (start & 7)) & 0xFF
+    tail = 0xFF >> (7 - (end & 7))
+    if first == last:
+        bitmap[first] |= head & tail
+        return
+    bitmap[first] |= head
+    bitmap[first + 1:last] = 0xFF
+    bitmap[last] |= tail
+
+
+def load_exclude_bitmap(path: Path) -> np.ndarray:
+    # 全 IPv4 空间的位图：地址 ip 对应 bitmap[ip >> 3] 的第 (ip & 7) 位，共 2^32 bit = 512 MB，
+    # np.zeros 的物理页按需分配。每行一个 CIDR / 单个 IP / a-b 区间，# 之后为注释（zmap/masscan 排除文件格式）
+    bitmap = np.zeros(1 << 29, dtype=np.uint8)
+    with open(path, "r") as f:
+        for line in f:
+            entry = line.split("#", 1)[0].strip()
+            if not entry:
+                continue
+            try:
+                if "-" in entry:
+                    lo, hi = entry.split("-", 1)
+                    start, end = ip_to_u32(lo.strip()), ip_to_u32(hi.strip())
+                else:
+                    addr, _, prefix = entry.partition("/")
+                    plen = int(prefix) if prefix else 32
+                    if not 0 <= plen <= 32:
+                        raise ValueError(entry)
+                    host_bits = (1 << (32 - plen)) - 1
+                    start = ip_to_u32(addr) & ~host_bits & 0xFFFFFFFF
+                    end = start | host_bits
+            except (OSError, ValueError):
+                logger.warning("排除文件中无法解析的条目：{}", entry)
+                continue
+            if start <= end:
+                _set_bit_range(bitmap, start, end)
+    return bitmap
+
+
+def excluded_mask(bitmap: np.ndarray, ips: np.ndarray) -> np.ndarray:
+    # 逐地址一次按位测试（向量化），返回布尔掩码
+    return ((bitmap[ips >> 3] >> (ips & 7).astype(np.uint8)) & 1).astype(bool)
+
+
+def filter_ips_by_not_in(other: Path, base: Path, out: Path, sink: Optional[List[np.ndarray]] = None, drop: Optional[Callable[[np.ndarray], np.ndarray]] = None) -> Path:
+    # 结果已排序去重，只输出 IP；传入 sink 时顺带收集结果，供调用方直接合并而无需回读 out。
+    # drop 在写出/收集前对非空结果再过滤一次（如按排除文件剔除），保证 out 与 sink 一致。
+    # 只把 base（通常远小于 other）整体载入；other 分块流式读取，逐块在有序的 base 上二分查找并标记命中
+    base_ips = _unique_u32_inplace(_load_ips_u32(base))
+    keep = np.ones(base_ips.size, dtype=bool)
+    if base_ips.size:
+        for chunk in _iter_ips_u32_chunks(other):
+            pos = np.minimum(np.searchsorted(base_ips, chunk), base_ips.size - 1)
+            keep[pos[base_ips[pos] == chunk]] = False
+    remaining = base_ips[keep]
+    if drop is not None and remaining.size:
+        remaining = drop(remaining)
+    if sink is not None:
+        sink.append(remaining)
+    return _write_ips_u32(remaining, out)
+
+
 @click.group()
 def cli():
     """三阶段扫描管道 (ZMap/Masscan + 内置应用层探测)。"""
 
 
+def _check_bandwidth(ctx: click.Context, param: click.Parameter, value: Optional[str]) -> Optional[str]:
+    # 解析期校验带宽格式，避免非法值拖到扫描线程里才报错
+    if value is not None:
+        try:
+            split_bandwidth(value, 1)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    return value
+
+
 @cli.command()
 @click.option("--output-dir", type=click.Path(path_type=Path), default=Path("outputs"))
 @click.option("--rate", type=int, default=10000)
@@ -237,7 +642,25 @@ def cli():
 @click.option("--exclude-file", type=click.Path(path_type=Path), default=None, help="排除文件 (IANA 保留地址等)")
 @click.option("--seed", type=int, default=1337)
 @click.option("--scanner", type=click.Choice(["auto", "zmap", "masscan"]), default="auto")
-def run_all(output_dir: Path, rate: int, iface: Optional[str], exclude_file: Optional[Path], seed: int, scanner: str):
+@click.option("--probe-workers", type=click.IntRange(min=1), default=256, help="阶段2 HTTP 探测并发线程数")
+@click.option("--banner-concurrency", type=click.IntRange(min=1), default=4096, help="阶段2 banner 类服务（ssh/ftp/mysql）asyncio 并发连接数")
+@click.option("--scan-workers", type=click.IntRange(min=1), default=2, help="并发扫描任务数（--rate 在任务间均分）")
+@click.option("--bandwidth", type=str, default=None, callback=_check_bandwidth, help="zmap 按带宽限速（如 10G），替代 --rate")
+@click.option("--send-threads", type=int, default=None, help="zmap 发送线程数（默认 4；检测到 PF_RING 时取 CPU 核数）")
+@click.option("--probe-module", type=str, default="tcp_synscan", help="zmap 探测模块")
+@click.option("--shard-host", "shard_hosts", type=str, multiple=True, help="分片扫描主机（SSH 目标，可重复指定），全网扫描按主机数分片")
+def run_all(output_dir: Path, rate: int, iface: Optional[str], exclude_file: Optional[Path], seed: int, scanner: str, probe_workers: int, banner_concurrency: int, scan_workers: int, bandwidth: Optional[str], send_threads: Optional[int], probe_module: str, shard_hosts: Tuple[str, ...]):
+    if bandwidth and scanner == "masscan":
+        raise click.UsageError("--bandwidth 仅支持 zmap，masscan 请用 --rate 限速")
+    if shard_hosts and scanner == "masscan":
+        # 分片模式依赖 zmap 的 --shards/--shard/--seed，masscan 无对应实现
+        raise click.UsageError("--shard-host 仅支持 zmap，不能与 --scanner masscan 同用")
+    if send_threads is None:
+        send_threads = 4
+        if pf_ring_available():
+            # PF_RING 绕过内核协议栈发包，发送吞吐可随核数扩展
+            send_threads = os.cpu_count() or send_threads
+            logger.info("检测到 PF_RING，zmap 发送线程数设为 {}", send_threads)
     cfg = ScanConfig(
         specified_ports=DEFAULT_SPECIFIED_PORTS,
         target_services=DEFAULT_TARGET_SERVICES,
@@ -247,110 +670,105 @@ def run_all(output_dir: Path, rate: int, iface: Optional[str], exclude_file: Opt
         seed=seed,
         exclude_file=exclude_file,
         scanner=scanner,
+        probe_workers=probe_workers,
+        banner_concurrency=banner_concurrency,
+        scan_workers=scan_workers,
+        bandwidth=bandwidth,
+        send_threads=send_threads,
+        probe_module=probe_module,
+        shards=list(shard_hosts),
     )
+    if cfg.bandwidth and cfg._resolved_scanner == "masscan":
+        # auto 回落到 masscan 时 -B 无对应参数，本机扫描改按 --rate 限速
+        logger.warning("masscan 不支持 --bandwidth，本机扫描将按 --rate={} 限速", cfg.rate)
 
     ensure_output_dir(cfg.output_dir)
 
     # 第一阶段
     logger.info("阶段1：从指定端口扫描目标端口，得到初始主机列表")
-    stage1_all_csvs: List[Path] = []
+    stage1_parts: List[np.ndarray] = []
     high_port = pick_random_high_port(cfg.seed)
-    
-    for spec in cfg.specified_ports:
-        for svc in cfg.target_services:
-            if svc["proto"] != "tcp":
-                continue
-            
-            # 第一步：从指定端口扫描目标端口，得到初始IP列表
-            initial_scan = scan_dispatch(cfg, target_port=svc["port"], src_port=spec["port"], tag=f"p{spec['port']}_to_{svc['name']}{svc['port']}")
-            
-            # 第二步：在初始IP列表范围内，用高端口进行扫描验证
-            if initial_scan.exists() and initial_scan.stat().st_size > 0:
-                # 用高端口扫描这些IP（只在初始IP列表范围内扫描）
-                high_port_scan = scan_dispatch(cfg, target_port=svc["port"], src_port=high_port, tag=f"high{high_port}_to_{svc['name']}{svc['port']}", target_ips=initial_scan)
-                
-                # 从初始列表中去除高端口扫描有响应的IP
-                remaining = filter_ips_by_not_in(other=high_port_scan, base=initial_scan, out=cfg.output_dir / f"stage1_{svc['name']}_from_{spec['port']}_only.csv")
-                stage1_all_csvs.append(remaining)
-            else:
-                # 如果初始扫描没有结果，直接使用空文件
-                empty_file = cfg.output_dir / f"stage1_{svc['name']}_from_{spec['port']}_only.csv"
-                empty_file.touch()
-                stage1_all_csvs.append(empty_file)
+    pairs = [(spec, svc) for spec in cfg.specified_ports for svc in cfg.target_services if svc["proto"] == "tcp"]
+
+    # 第一步：从指定端口扫描目标端口，得到初始IP列表（各组合并发扫描）
+    initial_scans = scan_many(cfg, [(svc["port"], spec["port"], f"p{spec['port']}_to_{svc['name']}{svc['port']}", None) for spec, svc in pairs])
+
+    # 第二步：在初始IP列表范围内，用高端口进行扫描验证（只扫描有初始结果的组合）
+    hit_idx = [i for i, f in enumerate(initial_scans) if f.exists() and f.stat().st_size > 0]
+    high_jobs: List[ScanJob] = []
+    for i in hit_idx:
+        spec, svc = pairs[i]
+        high_jobs.append((svc["port"], high_port, f"high{high_port}_from{spec['port']}_to_{svc['name']}{svc['port']}", initial_scans[i]))
+    high_scans = dict(zip(hit_idx, scan_many(cfg, high_jobs)))
+
+    # 扫描器是否正确应用了排除文件（如分片远端缺少该文件）都不影响：各组合结果写出前在本地再按位图剔除一次。
+    # 位图（512 MB）只在确有候选需要过滤时才加载
+    exclude_bitmap: List[np.ndarray] = []
+    excluded_total = 0
+
+    def drop_excluded(ips: np.ndarray) -> np.ndarray:
+        nonlocal excluded_total
+        if not exclude_bitmap:
+            exclude_bitmap.append(load_exclude_bitmap(cfg.exclude_file))
+        excluded = excluded_mask(exclude_bitmap[0], ips)
+        excluded_total += int(excluded.sum())
+        return ips[~excluded]
+
+    for i, (spec, svc) in enumerate(pairs):
+        stage1_out = cfg.output_dir / f"stage1_{svc['name']}_from_{spec['port']}_only.csv"
+        if i in high_scans:
+            # 从初始列表中去除高端口扫描有响应的IP
+            filter_ips_by_not_in(other=high_scans[i], base=initial_scans[i], out=stage1_out, sink=stage1_parts, drop=drop_excluded if cfg.exclude_file else None)
+        else:
+            # 如果初始扫描没有结果，直接使用空文件
+            stage1_out.touch()
 
     # 合并 stage1 候选
     union_stage1 = cfg.output_dir / "stage1_candidates.csv"
-    unique = set()
-    for f in stage1_all_csvs:
-        with open(f, "r") as rf:
-            for line in rf:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                ip = line.split(",")[0]
-                if ip:
-                    unique.add(ip)
-    with open(union_stage1, "w") as wf:
-        for ip in sorted(unique):
-            wf.write(f"{ip}\n")  # 只输出IP地址，不包含逗号和额外字段
+    if excluded_total:
+        logger.warning("阶段1 各组合结果中共有 {} 个地址命中排除文件，已剔除", excluded_total)
+    unique = _unique_u32_inplace(np.concatenate(stage1_parts)) if stage1_parts else np.empty(0, dtype=np.uint32)
+    _write_ips_u32(unique, union_stage1)  # 只输出IP地址，不包含逗号和额外字段
 
     # 第二阶段：对候选主机的指定端口发应用层探测
     logger.info("阶段2：应用层探测候选主机")
     responses_paths: List[Path] = []
+    # 候选列表对所有 (spec, svc) 组合相同：直接由内存中的合并结果生成一次，不再逐组合回读 union_stage1
+    ips = u32s_to_ips(unique)
     for spec in cfg.specified_ports:
         for svc in cfg.target_services:
             if svc["proto"] != "tcp":
                 continue
-            csv_input = union_stage1
             out_json = cfg.output_dir / f"stage2_{svc['name']}_on_{spec['port']}.jsonl"
-            count = 0
-            with open(csv_input, "r") as rf, open(out_json, "w", encoding="utf-8") as wf:
-                for line in rf:
-                    line = line.strip()
-                    if not line or line.startswith("#"):
-                        continue
-                    ip = line.split(",")[0]
-                    if not ip:
-                        continue
-                    res = probe_service(ip, svc["name"], spec["port"])  # 指定端口=探测端口
-                    if res is not None:
-                        wf.write(json.dumps({"ip": ip, "service": svc["name"], "port": spec["port"], "result": res}, ensure_ascii=False) + "\n")
-                        count += 1
+            # 每行只有 ip 与 result 变化：service/port 部分按组合预先序列化一次，逐行只拼接字节。
+            # 行格式同 {"ip": ..., "service": ..., "port": ..., "result": ...}；点分 IP 无需转义
+            line_mid = b'",' + orjson.dumps({"service": svc["name"], "port": spec["port"]})[1:-1] + b',"result":'
+            with open(out_json, "wb", buffering=WRITE_BUFFER) as wf:
+                buf: List[bytes] = []
+
+                def emit(ip: str, res: dict) -> None:
+                    # orjson 直接产出 UTF-8 bytes（不转义非 ASCII，同 ensure_ascii=False）
+                    buf.append(b'{"ip":"' + ip.encode() + line_mid + orjson.dumps(res) + b"}\n")
+                    if len(buf) >= JSONL_BATCH:
+                        wf.writelines(buf)
+                        buf.clear()
+
+                count = probe_candidates(ips, svc["name"], spec["port"], cfg, emit)  # 指定端口=探测端口
+                wf.writelines(buf)
             logger.info("{}:{} 探测响应 {} 条", svc["name"], spec["port"], count)
             responses_paths.append(out_json)
 
     # 第三阶段：高端口验证
     logger.info("阶段3：高端口验证并去除误报")
-    verified_paths: List[Path] = []
     high_port2 = pick_random_high_port(cfg.seed + 1)
-    for svc in cfg.target_services:
-        if svc["proto"] != "tcp":
-            continue
-        # 只在候选IP范围内进行高端口验证
-        csv_verify = scan_dispatch(cfg, target_port=svc["port"], src_port=high_port2, tag=f"verify_high{high_port2}_to_{svc['name']}{svc['port']}", target_ips=union_stage1)
-        verified_paths.append(csv_verify)
+    # 只在候选IP范围内进行高端口验证
+    verified_paths = scan_many(cfg, [(svc["port"], high_port2, f"verify_high{high_port2}_to_{svc['name']}{svc['port']}", union_stage1) for svc in cfg.target_services if svc["proto"] == "tcp"])
 
     # 汇总最终通过验证的列表：从 stage1 合并候选中剔除第三阶段仍可命中的 IP
     final_list = cfg.output_dir / "final_verified.csv"
-    verify_union: set[str] = set()
-    for vp in verified_paths:
-        if vp.exists():
-            with open(vp, "r") as vf:
-                for line in vf:
-                    line = line.strip()
-                    if not line or line.startswith("#"):
-                        continue
-                    ip = line.split(",")[0]
-                    if ip:
-                        verify_union.add(ip)
-    with open(union_stage1, "r") as uf, open(final_list, "w") as fw:
-        for line in uf:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            ip = line.split(",")[0]
-            if ip and ip not in verify_union:
-                fw.write(f"{ip}\n")  # 只输出IP地址
+    verify_parts = [_load_ips_u32(vp) for vp in verified_paths if vp.exists()]
+    verify_union = np.concatenate(verify_parts) if verify_parts else np.empty(0, dtype=np.uint32)
+    _write_ips_u32(np.setdiff1d(unique, verify_union), final_list)  # 只输出IP地址
 
     logger.info("完成。输出路径位于: {}", cfg.output_dir.resolve())
     logger.info("最终通过验证的列表: {} (共 {} 个)", final_list, sum(1 for _ in open(final_list)))